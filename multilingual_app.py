@@ -1,4 +1,5 @@
 import random
+from typing import Iterator
 import numpy as np
 import torch
 from chatterbox.mtl_tts import ChatterboxMultilingualTTS, SUPPORTED_LANGUAGES
@@ -7,6 +8,12 @@ import gradio as gr
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 print(f"🚀 Running on device: {DEVICE}")
 
+# bf16 keeps the fp32 dynamic range; fp16 on pre-Ampere GPUs, where bf16 is only emulated (and slower than fp16).
+AMP_DTYPE = (
+    torch.bfloat16 if DEVICE == "cuda" and torch.cuda.is_bf16_supported(including_emulation=False)
+    else torch.float16
+)
+
 # --- Global Model Initialization ---
 MODEL = None
 
@@ -183,7 +190,7 @@ def generate_tts_audio(
     temperature_input: float = 0.8,
     seed_num_input: int = 0,
     cfgw_input: float = 0.5
-) -> tuple[int, np.ndarray]:
+) -> Iterator[tuple[int, np.ndarray]]:
     """
     Generate high-quality speech audio from text using Chatterbox Multilingual model with optional reference audio styling.
     Supported languages: English, French, German, Spanish, Italian, Portuguese, and Hindi.
@@ -201,8 +208,9 @@ def generate_tts_audio(
         seed_num_input (int, optional): Random seed for reproducible results (0 for random generation). Defaults to 0.
         cfgw_input (float, optional): CFG/Pace weight controlling generation guidance (0.2-1.0). Defaults to 0.5, 0 for language transfer. 
 
-    Returns:
-        tuple[int, np.ndarray]: A tuple containing the sample rate (int) and the generated audio waveform (numpy.ndarray)
+    Yields:
+        tuple[int, np.ndarray]: The sample rate (int) and the next chunk of the generated audio waveform (numpy.ndarray),
+        streamed as soon as each chunk is synthesized
     """
     current_model = get_or_load_model()
 
@@ -228,13 +236,19 @@ def generate_tts_audio(
     else:
         print("No audio prompt provided; using default voice.")
         
-    wav = current_model.generate(
+    stream = current_model.generate_stream(
         text_input[:300],  # Truncate text to max chars
         language_id=language_id,
         **generate_kwargs
     )
+    while True:
+        # NOTE: enter the contexts around each step only, consecutive steps may run on different worker threads
+        with torch.inference_mode(), torch.autocast(DEVICE, dtype=AMP_DTYPE, enabled=(DEVICE != "cpu")):
+            wav = next(stream, None)
+        if wav is None:
+            break
+        yield (current_model.sr, wav.squeeze(0).numpy())
     print("Audio generation complete.")
-    return (current_model.sr, wav.squeeze(0).numpy())
 
 with gr.Blocks() as demo:
     gr.Markdown(
@@ -288,7 +302,7 @@ with gr.Blocks() as demo:
             run_btn = gr.Button("Generate", variant="primary")
 
         with gr.Column():
-            audio_output = gr.Audio(label="Output Audio")
+            audio_output = gr.Audio(label="Output Audio", streaming=True, autoplay=True)
 
         def on_language_change(lang, current_ref, current_text):
             return default_audio_for_ui(lang), default_text_for_ui(lang)
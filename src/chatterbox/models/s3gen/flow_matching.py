@@ -12,10 +12,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import threading
+from contextlib import nullcontext
+from functools import lru_cache
 import torch
 import torch.nn.functional as F
 from .matcha.flow_matching import BASECFM
 from .configs import CFM_PARAMS
+from ..utils import compile_enabled
+
+
+@lru_cache(maxsize=8)
+def _make_t_span(n_timesteps, dtype, device, t_scheduler):
+    # NOTE: shared between calls, must not be modified in place
+    t_span = torch.linspace(0, 1, n_timesteps + 1, device=device, dtype=dtype)
+    if t_scheduler == 'cosine':
+        t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
+    return t_span
 
 
 class ConditionalCFM(BASECFM):
@@ -33,6 +45,8 @@ class ConditionalCFM(BASECFM):
         # Just change the architecture of the estimator here
         self.estimator = estimator
         self.lock = threading.Lock()
+        # compiled `solve_euler`, see `get_solver`
+        self._compiled_solve_euler = None
 
     @torch.inference_mode()
     def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2)):
@@ -54,20 +68,47 @@ class ConditionalCFM(BASECFM):
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
+        # NOTE: the ODE state is integrated in fp32 even under autocast (where the encoder hands over half
+        #   precision); autocast then only applies to the ops inside the estimator.
+        mu = mu.float()
         z = torch.randn_like(mu).to(mu.device).to(mu.dtype) * temperature
         cache_size = flow_cache.shape[2]
         # fix prompt and overlap part mu and z
         if cache_size != 0:
             z[:, :, :cache_size] = flow_cache[:, :, :, 0]
             mu[:, :, :cache_size] = flow_cache[:, :, :, 1]
-        z_cache = torch.concat([z[:, :, :prompt_len], z[:, :, -34:]], dim=2)
-        mu_cache = torch.concat([mu[:, :, :prompt_len], mu[:, :, -34:]], dim=2)
-        flow_cache = torch.stack([z_cache, mu_cache], dim=-1)
+        # cache = [prompt part, last 34 frames] of z and mu, written straight into one (B, C, T_cache, 2) buffer
+        n_prompt, n_overlap = z[:, :, :prompt_len].size(2), z[:, :, -34:].size(2)
+        flow_cache = torch.empty(*z.shape[:2], n_prompt + n_overlap, 2, device=mu.device, dtype=mu.dtype)
+        flow_cache[:, :, :n_prompt, 0] = z[:, :, :prompt_len]
+        flow_cache[:, :, n_prompt:, 0] = z[:, :, -34:]
+        flow_cache[:, :, :n_prompt, 1] = mu[:, :, :prompt_len]
+        flow_cache[:, :, n_prompt:, 1] = mu[:, :, -34:]
 
-        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
-        if self.t_scheduler == 'cosine':
-            t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
+        t_span = _make_t_span(n_timesteps, mu.dtype, mu.device, self.t_scheduler)
+        solve_euler = self.get_solver(z, mu, mask, cond)
+        return solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
+
+    def get_solver(self, *seq_inputs):
+        """
+        Returns `solve_euler`, compiled with `CHATTERBOX_COMPILE=1`. The integration loop is unrolled into a single
+        graph (with the estimator), and only the mel length of `seq_inputs` is dynamic; the number of steps is
+        static, so each `n_timesteps` recompiles once (all of them share dynamo's per-function cache / limit).
+        NOTE: the single graph relies on the estimator not graph-breaking (no host syncs, see
+          `add_optional_chunk_mask`); check with `torch._dynamo.explain(self.solve_euler)` after changing it.
+        """
+        if not compile_enabled() or not isinstance(self.estimator, torch.nn.Module):
+            return self.solve_euler
+        for seq_input in seq_inputs:
+            if seq_input is not None:
+                torch._dynamo.mark_dynamic(seq_input, 2)
+        if self._compiled_solve_euler is None:
+            # NOTE: no CUDA graphs, their output buffers are reused by the next call while the mel may
+            # still be pending (e.g. vocoded on a side stream)
+            self._compiled_solve_euler = torch.compile(
+                self.solve_euler, mode="max-autotune-no-cudagraphs", dynamic=False
+            )
+        return self._compiled_solve_euler
 
     def solve_euler(self, x, t_span, mu, mask, spks, cond):
         """
@@ -91,56 +132,81 @@ class ConditionalCFM(BASECFM):
         # Or in future might add like a return_all_steps flag
         sol = []
 
+        # Classifier-Free Guidance inference introduced in VoiceBox. The second (unconditional) half of
+        # the batch is only needed when guidance is on; it stays all-zero apart from x and t.
+        use_cfg = self.inference_cfg_rate != 0
+        B = x.size(0)
+        n = 2 * B if use_cfg else B
+
         # Do not use concat, it may cause memory format changed and trt infer with wrong results!
-        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=x.dtype)
-        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        t_in = torch.zeros([2], device=x.device, dtype=x.dtype)
-        spks_in = torch.zeros([2, 80], device=x.device, dtype=x.dtype)
-        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        for step in range(1, len(t_span)):
-            # Classifier-Free Guidance inference introduced in VoiceBox
-            x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
-            t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
-            dphi_dt = self.forward_estimator(
-                x_in, mask_in,
-                mu_in, t_in,
-                spks_in,
-                cond_in
-            )
-            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
+        x_in = torch.zeros([n, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        mask_in = torch.zeros([n, 1, x.size(2)], device=x.device, dtype=x.dtype)
+        mu_in = torch.zeros([n, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        t_in = torch.zeros([n], device=x.device, dtype=x.dtype)
+        spks_in = torch.zeros([n, 80], device=x.device, dtype=x.dtype)
+        cond_in = torch.zeros([n, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        # mask, mu, spks and cond are constant over the solve, so fill them once
+        mask_in[:B] = mask
+        if use_cfg:
+            mask_in[B:] = mask
+        mu_in[:B] = mu
+        spks_in[:B] = spks
+        cond_in[:B] = cond
+        # The input shapes and buffers are fixed for the whole solve, so a TensorRT engine is only set up
+        # once and is held for all the steps.
+        use_trt = not isinstance(self.estimator, torch.nn.Module)
+        with self.lock if use_trt else nullcontext():
+            trt_bindings = self._set_trt_bindings(x_in, mask_in, mu_in, t_in, spks_in, cond_in) if use_trt else None
+            for step in range(1, len(t_span)):
+                x_in[:B] = x
+                if use_cfg:
+                    x_in[B:] = x
+                t_in[:] = t
+                dphi_dt = self.forward_estimator(
+                    x_in, mask_in,
+                    mu_in, t_in,
+                    spks_in,
+                    cond_in,
+                    trt_bindings=trt_bindings,
+                )
+                if use_cfg:
+                    # (1 + w) * cond - w * uncond == lerp(uncond, cond, 1 + w)
+                    dphi_dt = torch.lerp(dphi_dt[B:], dphi_dt[:B], 1.0 + self.inference_cfg_rate)
+                x = torch.addcmul(x, dt, dphi_dt)
+                t = t + dt
+                sol.append(x)
+                if step < len(t_span) - 1:
+                    dt = t_span[step + 1] - t
 
         return sol[-1].float()
 
-    def forward_estimator(self, x, mask, mu, t, spks, cond):
+    def _set_trt_bindings(self, x, mask, mu, t, spks, cond):
+        """
+        Sets the TensorRT input shapes and returns the `execute_v2` bindings; the engine writes its output into `x`.
+        NOTE: must be called with `self.lock` held, and the bindings are only valid as long as the buffers are.
+        """
+        inputs = (x, mask, mu, t, spks, cond)
+        assert all(tensor.is_contiguous() for tensor in inputs), "TensorRT inputs must be contiguous"
+        B = x.size(0)
+        self.estimator.set_input_shape('x', (B, 80, x.size(2)))
+        self.estimator.set_input_shape('mask', (B, 1, x.size(2)))
+        self.estimator.set_input_shape('mu', (B, 80, x.size(2)))
+        self.estimator.set_input_shape('t', (B,))
+        self.estimator.set_input_shape('spks', (B, 80))
+        self.estimator.set_input_shape('cond', (B, 80, x.size(2)))
+        return [tensor.data_ptr() for tensor in inputs] + [x.data_ptr()]
+
+    def forward_estimator(self, x, mask, mu, t, spks, cond, trt_bindings=None):
         if isinstance(self.estimator, torch.nn.Module):
             return self.estimator.forward(x, mask, mu, t, spks, cond)
+        elif trt_bindings is not None:
+            # run trt engine, shapes were already set by the caller
+            self.estimator.execute_v2(trt_bindings)
+            return x
         else:
             with self.lock:
-                self.estimator.set_input_shape('x', (2, 80, x.size(2)))
-                self.estimator.set_input_shape('mask', (2, 1, x.size(2)))
-                self.estimator.set_input_shape('mu', (2, 80, x.size(2)))
-                self.estimator.set_input_shape('t', (2,))
-                self.estimator.set_input_shape('spks', (2, 80))
-                self.estimator.set_input_shape('cond', (2, 80, x.size(2)))
                 # run trt engine
-                self.estimator.execute_v2([x.contiguous().data_ptr(),
-                                           mask.contiguous().data_ptr(),
-                                           mu.contiguous().data_ptr(),
-                                           t.contiguous().data_ptr(),
-                                           spks.contiguous().data_ptr(),
-                                           cond.contiguous().data_ptr(),
-                                           x.data_ptr()])
+                self.estimator.execute_v2(self._set_trt_bindings(x, mask, mu, t, spks, cond))
             return x
 
     def compute_loss(self, x1, mask, mu, spks=None, cond=None):
@@ -176,9 +242,13 @@ class ConditionalCFM(BASECFM):
         # during training, we randomly drop condition to trade off mode coverage and sample fidelity
         if self.training_cfg_rate > 0:
             cfg_mask = torch.rand(b, device=x1.device) > self.training_cfg_rate
-            mu = mu * cfg_mask.view(-1, 1, 1)
-            spks = spks * cfg_mask.view(-1, 1)
-            cond = cond * cfg_mask.view(-1, 1, 1)
+            # zero the dropped rows in place rather than allocating three masked copies
+            # NOTE: fine for the caller, `MaskedDiffWithXvec.forward`, which passes freshly computed tensors it
+            #   doesn't reuse; other callers must not rely on `mu` / `spks` / `cond` being left untouched
+            drop_idx = (~cfg_mask).nonzero(as_tuple=True)[0]
+            mu[drop_idx] = 0
+            spks[drop_idx] = 0
+            cond[drop_idx] = 0
 
         pred = self.estimator(y, mask, mu, t.squeeze(), spks, cond)
         loss = F.mse_loss(pred * mask, u * mask, reduction="sum") / (torch.sum(mask) * u.shape[1])
@@ -188,7 +258,12 @@ class ConditionalCFM(BASECFM):
 class CausalConditionalCFM(ConditionalCFM):
     def __init__(self, in_channels=240, cfm_params=CFM_PARAMS, n_spks=1, spk_emb_dim=80, estimator=None):
         super().__init__(in_channels, cfm_params, n_spks, spk_emb_dim, estimator)
-        self.rand_noise = torch.randn([1, 80, 50 * 300])
+        # NOTE: the noise is fixed (rather than sampled per call) so that re-running the flow on a growing token
+        # sequence stays close to the frames already emitted; it does not reproduce them exactly, since the
+        # encoder and estimator attend over the full context, so the streaming path re-vocodes the overlap to
+        # hide the difference. As a buffer it follows the module's device, so it isn't copied host-to-device on
+        # every call.
+        self.register_buffer("rand_noise", torch.randn([1, 80, 50 * 300]), persistent=False)
 
     @torch.inference_mode()
     def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None):
@@ -210,9 +285,11 @@ class CausalConditionalCFM(ConditionalCFM):
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
-        z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
+        # NOTE: the ODE state is integrated in fp32 even under autocast (where the encoder hands over half
+        #   precision); autocast then only applies to the ops inside the estimator.
+        mu = mu.float()
+        z = self.rand_noise[:, :, :mu.size(2)].to(mu.dtype) * temperature
         # fix prompt and overlap part mu and z
-        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
-        if self.t_scheduler == 'cosine':
-            t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), None
+        t_span = _make_t_span(n_timesteps, mu.dtype, mu.device, self.t_scheduler)
+        solve_euler = self.get_solver(z, mu, mask, cond)
+        return solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), None
@@ -17,20 +17,28 @@ import logging
 import numpy as np
 import torch
 import torchaudio as ta
-from functools import lru_cache
 from typing import Optional
 
 from ..s3tokenizer import S3_SR, SPEECH_VOCAB_SIZE, S3Tokenizer
 from .const import S3GEN_SR
 from .flow import CausalMaskedDiffWithXvec
 from .xvector import CAMPPlus
-from .utils.mel import mel_spectrogram
+from .utils.mel import MelSpectrogram
 from .f0_predictor import ConvRNNF0Predictor
 from .hifigan import HiFTGenerator
 from .transformer.upsample_encoder import UpsampleConformerEncoder
 from .flow_matching import CausalConditionalCFM
 from .decoder import ConditionalDecoder
 from .configs import CFM_PARAMS
+from ..utils import full_precision
+
+
+def fade_in_out(fade_in_wav, fade_out_wav, window):
+    """Cross-fades the start of `fade_in_wav` with the end of `fade_out_wav` (in place), over half of `window`."""
+    overlap_len = window.shape[0] // 2
+    fade_in_wav[..., :overlap_len] = fade_in_wav[..., :overlap_len] * window[:overlap_len] + \
+        fade_out_wav[..., -overlap_len:] * window[overlap_len:]
+    return fade_in_wav
 
 
 def drop_invalid_tokens(x):
@@ -38,12 +46,6 @@ def drop_invalid_tokens(x):
     return x[x < SPEECH_VOCAB_SIZE]
 
 
-# TODO: global resampler cache
-@lru_cache(100)
-def get_resampler(src_sr, dst_sr, device):
-    return ta.transforms.Resample(src_sr, dst_sr).to(device)
-
-
 class S3Token2Mel(torch.nn.Module):
     """
     CosyVoice2's CFM decoder maps S3 speech tokens to mel-spectrograms.
@@ -53,7 +55,7 @@ class S3Token2Mel(torch.nn.Module):
     def __init__(self):
         super().__init__()
         self.tokenizer = S3Tokenizer("speech_tokenizer_v2_25hz")
-        self.mel_extractor = mel_spectrogram # TODO: make it a torch module?
+        self.mel_extractor = MelSpectrogram()
         self.speaker_encoder = CAMPPlus()  # use default args
 
         encoder = UpsampleConformerEncoder(
@@ -85,6 +87,8 @@ class S3Token2Mel(torch.nn.Module):
             num_heads=8,
             act_fn='gelu',
         )
+        # NOTE: with `CHATTERBOX_COMPILE=1` the estimator is compiled as part of the CFM's per-`n_timesteps`
+        #   solver graphs (see `ConditionalCFM.get_solver`), rather than on its own
         cfm_params = CFM_PARAMS
         decoder = CausalConditionalCFM(
             spk_emb_dim=80,
@@ -97,13 +101,23 @@ class S3Token2Mel(torch.nn.Module):
             decoder=decoder
         )
 
-        self.resamplers = {}
+        # lazily populated with one resampler per (src_sr, dst_sr), see `get_resampler`
+        self.resamplers = torch.nn.ModuleDict()
 
     @property
     def device(self):
         params = self.tokenizer.parameters()
         return next(params).device
 
+    def get_resampler(self, src_sr, dst_sr, device):
+        key = f"{src_sr}_{dst_sr}"
+        if key not in self.resamplers:
+            # NOTE: the sinc kernel is a non-persistent buffer (and absent when `src_sr == dst_sr`, where
+            #   `Resample` is the identity), so the resamplers never show up in the state dict
+            self.resamplers[key] = ta.transforms.Resample(src_sr, dst_sr)
+        return self.resamplers[key].to(device)
+
+    @full_precision
     def embed_ref(
         self,
         ref_wav: torch.Tensor,
@@ -126,13 +140,13 @@ class S3Token2Mel(torch.nn.Module):
 
         ref_wav_24 = ref_wav
         if ref_sr != S3GEN_SR:
-            ref_wav_24 = get_resampler(ref_sr, S3GEN_SR, device)(ref_wav)
+            ref_wav_24 = self.get_resampler(ref_sr, S3GEN_SR, device)(ref_wav)
 
         ref_mels_24 = self.mel_extractor(ref_wav_24).transpose(1, 2).to(device)
         ref_mels_24_len = None
 
         # Resample to 16kHz
-        ref_wav_16 = get_resampler(ref_sr, S3_SR, device)(ref_wav).to(device)
+        ref_wav_16 = self.get_resampler(ref_sr, S3_SR, device)(ref_wav).to(device)
 
         # Speaker embedding
         ref_x_vector = self.speaker_encoder.inference(ref_wav_16)
@@ -235,6 +249,13 @@ class S3Token2Wav(S3Token2Mel):
         trim_fade[n_trim:] = (torch.cos(torch.linspace(torch.pi, 0, n_trim)) + 1) / 2
         self.register_buffer("trim_fade", trim_fade, persistent=False) # (buffers get automatic device casting)
 
+        # streaming: number of mel frames (and matching HiFT source / speech samples) overlapping between chunks
+        self.stream_mel_cache_len = 8
+        self.stream_source_cache_len = self.stream_mel_cache_len * (S3GEN_SR // 50)  # 480 samples per mel frame
+        stream_window = torch.hamming_window(2 * self.stream_source_cache_len, periodic=False)
+        self.register_buffer("stream_window", stream_window, persistent=False)
+        self._vocoder_stream = None
+
     def forward(
         self,
         speech_tokens,
@@ -258,6 +279,25 @@ class S3Token2Wav(S3Token2Mel):
 
         return output_wavs
 
+    def quantize_(self, mode="int8"):
+        """
+        In-place weight-only `int8` / `fp8` quantization of the CFM estimator's linear layers (its transformer
+        blocks). Requires `torchao`, and must be called after the weights are loaded.
+        NOTE: HiFT is left as is; it is almost all convolutions, which torchao doesn't quantize, and its only
+          linear layers are the tiny F0 / source heads, where quantization could only cost accuracy.
+        """
+        try:
+            from torchao.quantization import quantize_, int8_weight_only, float8_weight_only
+        except ImportError:
+            logging.warning("torchao not available - S3Gen quantization skipped")
+            return self
+
+        config = {"int8": int8_weight_only, "fp8": float8_weight_only}[mode]
+        estimator = self.flow.decoder.estimator
+        if isinstance(estimator, torch.nn.Module):  # (TensorRT engines are built separately)
+            quantize_(estimator, config())
+        return self
+
     @torch.inference_mode()
     def flow_inference(
         self,
@@ -272,10 +312,11 @@ class S3Token2Wav(S3Token2Mel):
         return super().forward(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
 
     @torch.inference_mode()
+    @full_precision
     def hift_inference(self, speech_feat, cache_source: torch.Tensor = None):
         if cache_source is None:
             cache_source = torch.zeros(1, 1, 0).to(self.device)
-        return self.mel2wav.inference(speech_feat=speech_feat, cache_source=cache_source)
+        return self.mel2wav.inference(speech_feat=speech_feat.float(), cache_source=cache_source.float())
 
     @torch.inference_mode()
     def inference(
@@ -296,3 +337,85 @@ class S3Token2Wav(S3Token2Mel):
         output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
 
         return output_wavs, output_sources
+
+    @torch.inference_mode()
+    def inference_stream_step(
+        self,
+        speech_tokens,
+        ref_dict: dict,
+        token_offset: int = 0,
+        cache: Optional[dict] = None,
+        finalize: bool = False,
+        vocoder_stream: Optional["torch.cuda.Stream"] = None,
+    ):
+        """
+        One step of streaming synthesis (as in CosyVoice2). The flow is re-run on all the tokens so far, and only
+        the mels after `token_offset` are vocoded.
+
+        NOTE: the encoder and estimator attend over the full context (`static_chunk_size=0`), so a re-run does not
+          reproduce the already-emitted frames exactly; the fixed CFM noise only keeps them close. To hide this, HiFT
+          re-vocodes the last `stream_mel_cache_len` frames of the previous chunk (taken from this run, so its mel
+          input is continuous), continues from the cached source, and the new speech is cross-faded with the speech
+          tail held back by the previous step.
+        NOTE: re-running the flow on the whole prefix makes the total CFM cost quadratic in the utterance length.
+
+        Args
+        ----
+        - `speech_tokens`: all the S3 speech tokens so far [B=1, T]
+        - `token_offset`: number of tokens already synthesized by previous steps
+        - `cache`: the cache returned by the previous step, None for the first one
+        - `finalize`: whether this is the last step; else the last 3 (lookahead) tokens are not synthesized yet
+        - `vocoder_stream`: if given (see `get_vocoder_stream`), HiFT runs on this CUDA stream so that it overlaps
+          with whatever the caller queues next. The returned tensors are then only ready once the work queued on
+          `vocoder_stream` is done, eg, after synchronizing an event recorded on it.
+
+        Returns the new waveform chunk and the cache for the next step (None once finalized).
+        """
+        output_mels = self.flow_inference(speech_tokens, ref_dict=ref_dict, finalize=finalize)
+        mel_start = token_offset * self.flow.token_mel_ratio
+        if cache is not None:
+            # the overlap frames, whose speech the previous step held back
+            mel_start -= self.stream_mel_cache_len
+        output_mels = output_mels[:, :, mel_start:]
+        if vocoder_stream is None:
+            return self._vocode_stream_chunk(output_mels, cache, finalize)
+
+        # the mels are produced on the current stream, so don't let it reuse their memory before HiFT is done
+        vocoder_stream.wait_stream(torch.cuda.current_stream(self.device))
+        output_mels.record_stream(vocoder_stream)
+        with torch.cuda.stream(vocoder_stream):
+            return self._vocode_stream_chunk(output_mels, cache, finalize)
+
+    def get_vocoder_stream(self):
+        """
+        Side CUDA stream on which `inference_stream_step` can run HiFT, so that vocoding chunk k overlaps with
+        decoding the tokens of chunk k+1. None when not running on CUDA.
+        """
+        if self.device.type != "cuda":
+            return None
+        if self._vocoder_stream is None or self._vocoder_stream.device != self.device:
+            self._vocoder_stream = torch.cuda.Stream(device=self.device)
+        return self._vocoder_stream
+
+    def _vocode_stream_chunk(self, output_mels, cache, finalize):
+        """HiFT part of `inference_stream_step`."""
+        cache_source = torch.zeros(1, 1, 0).to(self.device) if cache is None else cache["source"]
+
+        output_wavs, output_sources = self.hift_inference(output_mels, cache_source)
+
+        if cache is None:
+            # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
+            output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
+        else:
+            output_wavs = fade_in_out(output_wavs, cache["speech"], self.stream_window)
+
+        if finalize:
+            return output_wavs, None
+
+        # hold back the tail, it is cross-faded with the start of the next chunk
+        n_cache = self.stream_source_cache_len
+        cache = dict(
+            source=output_sources[:, :, -n_cache:],
+            speech=output_wavs[:, -n_cache:],
+        )
+        return output_wavs[:, :-n_cache], cache
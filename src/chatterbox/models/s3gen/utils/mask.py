@@ -158,9 +158,11 @@ def add_optional_chunk_mask(xs: torch.Tensor,
     else:
         chunk_masks = masks
     assert chunk_masks.dtype == torch.bool
-    if (chunk_masks.sum(dim=-1) == 0).sum().item() != 0:
+    all_false = chunk_masks.sum(dim=-1, keepdim=True) == 0
+    # NOTE: the check is a host sync (and a graph break), so it is skipped when compiling, eg, the CFM solver
+    if not torch.compiler.is_compiling() and all_false.any().item():
         logging.warning('get chunk_masks all false at some timestep, force set to true, make sure they are masked in futuer computation!')
-        chunk_masks[chunk_masks.sum(dim=-1)==0] = True
+    chunk_masks = chunk_masks | all_false
     return chunk_masks
 
 
@@ -7,9 +7,8 @@ import numpy as np
 logger = logging.getLogger(__name__)
 
 
-# NOTE: they decalred these global vars
-mel_basis = {}
-hann_window = {}
+# `MelSpectrogram` modules backing `mel_spectrogram`, per settings and device
+_mel_extractors = {}
 
 
 def dynamic_range_compression_torch(x, C=1, clip_val=1e-5):
@@ -37,49 +36,71 @@ def mel_spectrogram(y, n_fft=1920, num_mels=80, sampling_rate=24000, hop_size=48
                     fmin=0, fmax=8000, center=False):
     """Copied from https://github.com/shivammehta25/Matcha-TTS/blob/main/matcha/utils/audio.py
     Set default values according to Cosyvoice's config.
+    Functional wrapper around `MelSpectrogram`, which holds the implementation.
     """
 
     if isinstance(y, np.ndarray):
         y = torch.tensor(y).float()
 
-    if len(y.shape) == 1:
-        y = y[None, ]
+    key = (n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center, str(y.device))
+    if key not in _mel_extractors:
+        _mel_extractors[key] = MelSpectrogram(
+            n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center
+        ).to(y.device)
+    return _mel_extractors[key](y)
 
-    # Debug: Check for audio clipping (values outside [-1.0, 1.0] range)
-    min_val = torch.min(y)
-    max_val = torch.max(y)
-    if min_val < -1.0 or max_val > 1.0:
-        logger.warning(f"Audio values outside normalized range: min={min_val.item():.4f}, max={max_val.item():.4f}")
 
-    global mel_basis, hann_window  # pylint: disable=global-statement,global-variable-not-assigned
-    if f"{str(fmax)}_{str(y.device)}" not in mel_basis:
+class MelSpectrogram(torch.nn.Module):
+    """
+    Matcha-TTS mel-spectrogram as a module (`mel_spectrogram` wraps it); the mel basis and window are
+    (non-persistent) buffers so they follow the module's device instead of being looked up per call.
+    """
+    def __init__(self, n_fft=1920, num_mels=80, sampling_rate=24000, hop_size=480, win_size=1920,
+                 fmin=0, fmax=8000, center=False):
+        super().__init__()
+        self.n_fft = n_fft
+        self.hop_size = hop_size
+        self.win_size = win_size
+        self.center = center
         mel = librosa_mel_fn(sr=sampling_rate, n_fft=n_fft, n_mels=num_mels, fmin=fmin, fmax=fmax)
-        mel_basis[str(fmax) + "_" + str(y.device)] = torch.from_numpy(mel).float().to(y.device)
-        hann_window[str(y.device)] = torch.hann_window(win_size).to(y.device)
-
-    y = torch.nn.functional.pad(
-        y.unsqueeze(1), (int((n_fft - hop_size) / 2), int((n_fft - hop_size) / 2)), mode="reflect"
-    )
-    y = y.squeeze(1)
-
-    spec = torch.view_as_real(
-        torch.stft(
-            y,
-            n_fft,
-            hop_length=hop_size,
-            win_length=win_size,
-            window=hann_window[str(y.device)],
-            center=center,
-            pad_mode="reflect",
-            normalized=False,
-            onesided=True,
-            return_complex=True,
+        self.register_buffer("mel_basis", torch.from_numpy(mel).float(), persistent=False)
+        self.register_buffer("hann_window", torch.hann_window(win_size), persistent=False)
+
+    def forward(self, y):
+        if isinstance(y, np.ndarray):
+            y = torch.tensor(y).float()
+
+        if len(y.shape) == 1:
+            y = y[None, ]
+
+        # Debug: Check for audio clipping (values outside [-1.0, 1.0] range)
+        min_val = torch.min(y)
+        max_val = torch.max(y)
+        if min_val < -1.0 or max_val > 1.0:
+            logger.warning(f"Audio values outside normalized range: min={min_val.item():.4f}, max={max_val.item():.4f}")
+
+        return self.log_mel(y.to(self.mel_basis.device).float())
+
+    def log_mel(self, y):
+        pad = int((self.n_fft - self.hop_size) / 2)
+        y = torch.nn.functional.pad(y.unsqueeze(1), (pad, pad), mode="reflect").squeeze(1)
+
+        spec = torch.view_as_real(
+            torch.stft(
+                y,
+                self.n_fft,
+                hop_length=self.hop_size,
+                win_length=self.win_size,
+                window=self.hann_window,
+                center=self.center,
+                pad_mode="reflect",
+                normalized=False,
+                onesided=True,
+                return_complex=True,
+            )
         )
-    )
-
-    spec = torch.sqrt(spec.pow(2).sum(-1) + (1e-9))
 
-    spec = torch.matmul(mel_basis[str(fmax) + "_" + str(y.device)], spec)
-    spec = spectral_normalize_torch(spec)
+        spec = torch.sqrt(spec.pow(2).sum(-1) + (1e-9))
 
-    return spec
+        spec = torch.matmul(self.mel_basis, spec)
+        return spectral_normalize_torch(spec)
@@ -3,8 +3,10 @@
 # MIT License
 import logging
 import torch
+import torch.nn.functional as F
 from dataclasses import dataclass
 from types import MethodType
+from transformers.models.llama.modeling_llama import apply_rotary_pos_emb
 
 
 logger = logging.getLogger(__name__)
@@ -30,7 +32,7 @@ class AlignmentAnalysisResult:
 
 
 class AlignmentStreamAnalyzer:
-    def __init__(self, tfmr, queue, text_tokens_slice, alignment_layer_idx=9, eos_idx=0):
+    def __init__(self, tfmr, queue, text_tokens_slice, alignment_layer_idx=9, eos_idx=0, max_frames=1024):
         """
         Some transformer TTS models implicitly solve text-speech alignment in one or more of their self-attention
         activation maps. This module exploits this to perform online integrity checks which streaming.
@@ -38,11 +40,17 @@ class AlignmentStreamAnalyzer:
         position, repetition, etc.
 
         NOTE: currently requires no queues.
+
+        `max_frames` only sizes the initial alignment buffer; it is grown if generation runs longer.
         """
         # self.queue = queue
         self.text_tokens_slice = (i, j) = text_tokens_slice
         self.eos_idx = eos_idx
-        self.alignment = torch.zeros(0, j-i)
+        # pre-allocated (max_frames, S) history, of which the first `self._T` rows are filled
+        self._alignment_buf = torch.zeros(max_frames, j-i, device=tfmr.device)
+        self._T = 0
+        # text token count is fixed for the whole generation; the last 3 tokens count as "done" (see `step`)
+        self._S_minus_3 = (j - i) - 3
         # self.alignment_bin = torch.zeros(0, j-i)
         self.curr_frame_pos = 0
         self.text_position = 0
@@ -56,35 +64,80 @@ class AlignmentStreamAnalyzer:
         # Track generated tokens for repetition detection
         self.generated_tokens = []
 
-        # Using `output_attentions=True` is incompatible with optimized attention kernels, so
-        # using it for all layers slows things down too much. We can apply it to just one layer
-        # by intercepting the kwargs and adding a forward hook (credit: jrm)
+        # Using `output_attentions=True` is incompatible with optimized attention kernels, so instead of
+        # asking the aligned layers for their full attention maps, a forward hook recomputes just the
+        # attention rows of the aligned heads from the step's queries and the cached keys.
         self.last_aligned_attns = []
+        self._hook_handles = []
         for i, (layer_idx, head_idx) in enumerate(LLAMA_ALIGNED_HEADS):
             self.last_aligned_attns += [None]
             self._add_attention_spy(tfmr, i, layer_idx, head_idx)
 
     def _add_attention_spy(self, tfmr, buffer_idx, layer_idx, head_idx):
         """
-        Adds a forward hook to a specific attention layer to collect outputs.
+        Adds a forward hook to a specific attention layer to collect the attention weights of one head.
         """
-        def attention_forward_hook(module, input, output):
+        def attention_forward_hook(module, args, kwargs, output):
             """
-            See `LlamaAttention.forward`; the output is a 3-tuple: `attn_output, attn_weights, past_key_value`.
+            See `LlamaAttention.forward`. The hook recomputes `softmax(q k^T / sqrt(d))` for `head_idx` only,
+            so the layer itself can keep using SDPA / FlashAttention.
             NOTE:
-            - When `output_attentions=True`, `LlamaSdpaAttention.forward` calls `LlamaAttention.forward`.
-            - `attn_output` has shape [B, H, T0, T0] for the 0th entry, and [B, H, 1, T0+i] for the rest i-th.
+            - The keys are read from the KV-cache, which the layer has already updated with this step.
+            - The weights have shape [T0, T0] for the 0th entry, and [1, T0+i] for the rest i-th.
             """
-            if isinstance(output, tuple) and len(output) > 1 and output[1] is not None:
-                step_attention = output[1].cpu()  # (B, n_heads, T0, Ti)
-                self.last_aligned_attns[buffer_idx] = step_attention[0, head_idx]  # (T0, Ti)
+            hidden_states = args[0] if args else kwargs["hidden_states"]
+            hidden_states = hidden_states[:1]  # only the conditional batch is analyzed
+            head_dim = module.head_dim
+            kv_head_idx = head_idx // module.num_key_value_groups
+
+            # query of the aligned head only
+            q_weight = module.q_proj.weight[head_idx * head_dim:(head_idx + 1) * head_dim]
+            q = F.linear(hidden_states, q_weight).unsqueeze(1)  # (1, 1, Tq, d)
+
+            position_embeddings = kwargs.get("position_embeddings")
+            if position_embeddings is None:
+                position_embeddings = module.rotary_emb(hidden_states, kwargs["position_ids"])
+            cos, sin = position_embeddings
+
+            past_key_value = kwargs.get("past_key_value")
+            if past_key_value is not None:
+                k = past_key_value.key_cache[module.layer_idx][:1, kv_head_idx:kv_head_idx + 1]  # (1, 1, Tk, d)
+                q, _ = apply_rotary_pos_emb(q, q, cos[:1], sin[:1])
+            else:
+                k_weight = module.k_proj.weight[kv_head_idx * head_dim:(kv_head_idx + 1) * head_dim]
+                k = F.linear(hidden_states, k_weight).unsqueeze(1)
+                q, k = apply_rotary_pos_emb(q, k, cos[:1], sin[:1])
+
+            # NOTE: stays on device; moving it to the CPU here would force a sync every decoding step.
+            scores = (q.float() @ k.float().transpose(-1, -2))[0, 0] * head_dim ** -0.5  # (Tq, Tk)
+            Tq, Tk = scores.shape
+            if Tq > 1:
+                causal_mask = torch.ones(Tq, Tk, dtype=torch.bool, device=scores.device).triu(Tk - Tq + 1)
+                scores = scores.masked_fill(causal_mask, float("-inf"))
+            self.last_aligned_attns[buffer_idx] = scores.softmax(dim=-1)  # (T0, Ti)
 
         target_layer = tfmr.layers[layer_idx].self_attn
         # Register hook and store the handle
-        target_layer.register_forward_hook(attention_forward_hook)
-        if hasattr(tfmr, 'config') and hasattr(tfmr.config, 'output_attentions'):
-            self.original_output_attentions = tfmr.config.output_attentions
-            tfmr.config.output_attentions = True
+        self._hook_handles.append(target_layer.register_forward_hook(attention_forward_hook, with_kwargs=True))
+
+    def remove_hooks(self):
+        for handle in self._hook_handles:
+            handle.remove()
+        self._hook_handles = []
+
+    @property
+    def alignment(self):
+        return self._alignment_buf[:self._T]  # (T, S)
+
+    def _append_alignment(self, A_chunk):
+        T_new = self._T + A_chunk.shape[0]
+        buf = self._alignment_buf
+        if buf.device != A_chunk.device or T_new > buf.shape[0]:
+            grown = torch.zeros(max(T_new, 2 * buf.shape[0]), buf.shape[1], device=A_chunk.device)
+            grown[:self._T] = buf[:self._T]
+            self._alignment_buf = buf = grown
+        buf[self._T:T_new] = A_chunk
+        self._T = T_new
 
     def step(self, logits, next_token=None):
         """
@@ -95,48 +148,55 @@ class AlignmentStreamAnalyzer:
         i, j = self.text_tokens_slice
         if self.curr_frame_pos == 0:
             # first chunk has conditioning info, text tokens, and BOS token
-            A_chunk = aligned_attn[j:, i:j].clone().cpu() # (T, S)
+            A_chunk = aligned_attn[j:, i:j].float() # (T, S)
         else:
             # subsequent chunks have 1 frame due to KV-caching
-            A_chunk = aligned_attn[:, i:j].clone().cpu() # (1, S)
+            A_chunk = aligned_attn[:, i:j].float() # (1, S)
 
         # TODO: monotonic masking; could have issue b/c spaces are often skipped.
         A_chunk[:, self.curr_frame_pos + 1:] = 0
 
 
-        self.alignment = torch.cat((self.alignment, A_chunk), dim=0)
+        self._append_alignment(A_chunk)
 
         A = self.alignment
         T, S = A.shape
 
         # update position
-        cur_text_posn = A_chunk[-1].argmax()
+        # NOTE: everything stays on device; only the scalars we branch on are synced to the host.
+        cur_text_posn = int(A_chunk[-1].argmax().item())
         discontinuity = not(-4 < cur_text_posn - self.text_position < 7) # NOTE: very lenient!
         if not discontinuity:
             self.text_position = cur_text_posn
 
-        # Hallucinations at the start of speech show up as activations at the bottom of the attention maps!
-        # To mitigate this, we just wait until there are no activations far off-diagonal in the last 2 tokens,
-        # and there are some strong activations in the first few tokens.
-        false_start = (not self.started) and (A[-2:, -2:].max() > 0.1 or A[:, :4].max() < 0.5)
-        self.started = not false_start
-        if self.started and self.started_at is None:
-            self.started_at = T
-
-        # Is generation likely complete?
-        self.complete = self.complete or self.text_position >= S - 3
-        if self.complete and self.completed_at is None:
-            self.completed_at = T
-
-        # NOTE: EOS rarely assigned activations, and second-last token is often punctuation, so use last 3 tokens.
-        # NOTE: due to the false-start behaviour, we need to make sure we skip activations for the first few tokens.
-        last_text_token_duration = A[15:, -3:].sum()
-
-        # Activations for the final token that last too long are likely hallucinations.
-        long_tail = self.complete and (A[self.completed_at:, -3:].sum(dim=0).max() >= 5) # 200ms
-
-        # If there are activations in previous tokens after generation has completed, assume this is a repetition error.
-        alignment_repetition = self.complete and (A[self.completed_at:, :-5].max(dim=1).values.sum() > 5)
+        # Once complete, only the (short) tail window since `completed_at` matters; the start-of-speech checks are done.
+        if not self.complete:
+            # Hallucinations at the start of speech show up as activations at the bottom of the attention maps!
+            # To mitigate this, we just wait until there are no activations far off-diagonal in the last 2 tokens,
+            # and there are some strong activations in the first few tokens.
+            false_start = (not self.started) and bool(((A[-2:, -2:].max() > 0.1) | (A[:, :4].max() < 0.5)).item())
+            self.started = not false_start
+            if self.started and self.started_at is None:
+                self.started_at = T
+
+            # Is generation likely complete?
+            self.complete = self.text_position >= self._S_minus_3
+            if self.complete:
+                self.completed_at = T
+
+        long_tail = alignment_repetition = False
+        if self.complete:
+            # NOTE: EOS rarely assigned activations, and second-last token is often punctuation, so use last 3 tokens.
+            tail = A[self.completed_at:]
+
+            # Activations for the final token that last too long are likely hallucinations.
+            long_tail = tail[:, -3:].sum(dim=0).max() >= 5 # 200ms
+
+            # If there are activations in previous tokens after generation has completed, assume this is a repetition error.
+            alignment_repetition = tail[:, :-5].max(dim=1).values.sum() > 5
+
+            # single host sync for both checks
+            long_tail, alignment_repetition = torch.stack((long_tail, alignment_repetition)).tolist()
         
         # Track generated tokens for repetition detection
         if next_token is not None:
@@ -162,17 +222,17 @@ class AlignmentStreamAnalyzer:
             repeated_token = self.generated_tokens[-1]
             logger.warning(f"🚨 Detected 2x repetition of token {repeated_token}")
             
-        # Suppress EoS to prevent early termination
-        if cur_text_posn < S - 3 and S > 5:  # Only suppress if text is longer than 5 tokens
-            logits[..., self.eos_idx] = -2**15
-
-        # If a bad ending is detected, force emit EOS by modifying logits
-        # NOTE: this means logits may be inconsistent with latents!
+        # NOTE: `logits` is updated in-place (no full-vocab allocation), and left untouched when neither case applies.
+        # (±2**15 is safe for all dtypes >= 16bit)
         if long_tail or alignment_repetition or token_repetition:
+            # If a bad ending is detected, force emit EOS by modifying logits
+            # NOTE: this means logits may be inconsistent with latents!
             logger.warning(f"forcing EOS token, {long_tail=}, {alignment_repetition=}, {token_repetition=}")
-            # (±2**15 is safe for all dtypes >= 16bit)
-            logits = -(2**15) * torch.ones_like(logits)
+            logits.fill_(-2**15)
             logits[..., self.eos_idx] = 2**15
+        elif cur_text_posn < self._S_minus_3 and S > 5:  # Only suppress if text is longer than 5 tokens
+            # Suppress EoS to prevent early termination
+            logits[..., self.eos_idx] = -2**15
 
         self.curr_frame_pos += 1
         return logits
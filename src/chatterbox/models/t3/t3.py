@@ -19,7 +19,7 @@ from .modules.t3_config import T3Config
 from .llama_configs import LLAMA_CONFIGS
 from .inference.t3_hf_backend import T3HuggingfaceBackend
 from .inference.alignment_stream_analyzer import AlignmentStreamAnalyzer
-from ..utils import AttrDict
+from ..utils import AttrDict, compile_enabled
 
 
 logger = logging.getLogger(__name__)
@@ -50,6 +50,13 @@ class T3(nn.Module):
         self.tfmr = LlamaModel(self.cfg)
         self.dim = self.cfg.hidden_size
         self.deepspeed_patch_applied = False
+        if compile_enabled():
+            # NOTE: only the MLPs are compiled (attention already runs fused SDPA kernels). Whole decoder layers
+            #   graph-break in `DynamicCache.update` and recompile per layer (guards on the cache length), which
+            #   exhausts dynamo's cache size limit, whereas all the MLPs share two graphs (prefill / 1-token decode).
+            #   No CUDA graphs ("reduce-overhead") either, as the sequence length changes every step.
+            for layer in self.tfmr.layers:
+                layer.mlp.compile(dynamic=True)
 
         # conditioning / embedding
         self.cond_enc = T3CondEnc(hp)
@@ -229,6 +236,57 @@ class T3(nn.Module):
         cfg_weight=0.5,
     ):
         """
+        Args:
+            text_tokens: a 1D (unbatched) or 2D (batched) tensor.
+        """
+        predicted = self.inference_stream(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            initial_speech_tokens=initial_speech_tokens,
+            prepend_prompt_speech_tokens=prepend_prompt_speech_tokens,
+            num_return_sequences=num_return_sequences,
+            max_new_tokens=max_new_tokens,
+            stop_on_eos=stop_on_eos,
+            do_sample=do_sample,
+            temperature=temperature,
+            top_p=top_p,
+            min_p=min_p,
+            length_penalty=length_penalty,
+            repetition_penalty=repetition_penalty,
+            cfg_weight=cfg_weight,
+        )
+        # Concatenate all predicted tokens along the sequence dimension.
+        return torch.cat(list(predicted), dim=1)  # shape: (B, num_tokens)
+
+    @torch.inference_mode()
+    def inference_stream(
+        self,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: Tensor,
+        initial_speech_tokens: Optional[Tensor]=None,
+
+        # misc conditioning
+        prepend_prompt_speech_tokens: Optional[Tensor]=None,
+
+        # HF generate args
+        num_return_sequences=1,
+        max_new_tokens=None,
+        stop_on_eos=True,
+        do_sample=True,
+        temperature=0.8,
+        top_p=0.95,
+        min_p=0.05,
+        length_penalty=1.0,
+        repetition_penalty=1.2,
+        cfg_weight=0.5,
+        chunk_size=None,
+    ):
+        """
+        Same as `inference`, but yields the predicted tokens in chunks of `chunk_size` tokens as they are
+        sampled (all at once if `chunk_size` is None). The last chunk may be shorter, and ends with the EOS token
+        if one was sampled.
+
         Args:
             text_tokens: a 1D (unbatched) or 2D (batched) tensor.
         """
@@ -257,6 +315,11 @@ class T3(nn.Module):
         # TODO? synchronize the expensive compile function
         # with self.compile_lock:
         if not self.compiled:
+            # Detach the hooks of the analyzer from the previous call, if any
+            previous_model = getattr(self, "patched_model", None)
+            if previous_model is not None and previous_model.alignment_stream_analyzer is not None:
+                previous_model.alignment_stream_analyzer.remove_hooks()
+
             # Default to None for English models, only create for multilingual
             alignment_stream_analyzer = None
             if self.hp.is_multilingual:
@@ -266,6 +329,7 @@ class T3(nn.Module):
                     text_tokens_slice=(len_cond, len_cond + text_tokens.size(-1)),
                     alignment_layer_idx=9, # TODO: hparam or something?
                     eos_idx=self.hp.stop_speech_token,
+                    max_frames=(max_new_tokens or self.hp.max_speech_tokens) + 1,  # + BOS frame
                 )
                 assert alignment_stream_analyzer.eos_idx == self.hp.stop_speech_token
 
@@ -323,7 +387,7 @@ class T3(nn.Module):
             inputs_embeds=inputs_embeds,
             past_key_values=None,
             use_cache=True,
-            output_attentions=True,
+            output_attentions=False,
             output_hidden_states=True,
             return_dict=True,
         )
@@ -332,7 +396,9 @@ class T3(nn.Module):
 
         # ---- Generation Loop using kv_cache ----
         for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
-            logits_step = output.logits[:, -1, :]                
+            # Upcast before CFG/sampling: under autocast the head emits fp16/bf16 logits,
+            # which overflow on the forced-EOS path once divided by a low temperature.
+            logits_step = output.logits[:, -1, :].float()
             # CFG combine  → (1, V)
             cond   = logits_step[0:1, :]
             uncond = logits_step[1:2, :]
@@ -365,6 +431,9 @@ class T3(nn.Module):
 
             predicted.append(next_token)
             generated_ids = torch.cat([generated_ids, next_token], dim=1)
+            if chunk_size is not None and len(predicted) == chunk_size:
+                yield torch.cat(predicted, dim=1)  # shape: (B, chunk_size)
+                predicted = []
 
             # Check for EOS token.
             if next_token.view(-1) == self.hp.stop_speech_token:
@@ -382,13 +451,12 @@ class T3(nn.Module):
             output = self.patched_model(
                 inputs_embeds=next_token_embed,
                 past_key_values=past,
-                output_attentions=True,
+                output_attentions=False,
                 output_hidden_states=True,
                 return_dict=True,
             )
             # Update the kv_cache.
             past = output.past_key_values
 
-        # Concatenate all predicted tokens along the sequence dimension.
-        predicted_tokens = torch.cat(predicted, dim=1)  # shape: (B, num_tokens)
-        return predicted_tokens
+        if predicted:
+            yield torch.cat(predicted, dim=1)  # shape: (B, num_tokens)
@@ -1,4 +1,49 @@
+import os
+from functools import wraps
+
+import torch
+
+
 class AttrDict(dict):
     def __init__(self, *args, **kwargs):
         super(AttrDict, self).__init__(*args, **kwargs)
         self.__dict__ = self
+
+
+def compile_enabled():
+    """`torch.compile` warmup is slow, so compiling the hot modules is opt-in via `CHATTERBOX_COMPILE=1`."""
+    return os.getenv("CHATTERBOX_COMPILE", "0") == "1"
+
+
+def quantization_mode():
+    """Optional weight-only quantization of the S3Gen CFM estimator, via `CHATTERBOX_QUANT=int8|fp8`."""
+    mode = os.getenv("CHATTERBOX_QUANT", "").lower() or None
+    if mode not in (None, "int8", "fp8"):
+        raise ValueError(f"Unsupported CHATTERBOX_QUANT '{mode}'. Supported modes: int8, fp8")
+    return mode
+
+
+def to_numpy(wav):
+    """
+    `wav.float().cpu().numpy()`, but CUDA outputs are copied asynchronously into (cached) pinned host memory,
+    which skips the pageable staging copy and only waits on the current stream.
+    """
+    wav = wav.detach()
+    if not wav.is_cuda:
+        return wav.float().cpu().numpy()
+    host = torch.empty(wav.shape, dtype=torch.float32, pin_memory=True)
+    host.copy_(wav, non_blocking=True)  # (also casts, e.g. from half precision under autocast)
+    torch.cuda.current_stream(wav.device).synchronize()
+    return host.numpy()
+
+
+def full_precision(fn):
+    """
+    Runs `fn` outside of any caller autocast. The audio front-ends (resampling, STFTs, fbanks, the S3 tokenizer)
+    and HiFT's source / iSTFT path need fp32, and the reference conditionals are cached and reused.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with torch.autocast("cuda", enabled=False), torch.autocast("cpu", enabled=False):
+            return fn(*args, **kwargs)
+    return wrapper
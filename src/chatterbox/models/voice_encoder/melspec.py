@@ -1,75 +1,101 @@
 from functools import lru_cache
 
-from scipy import signal
 import numpy as np
 import librosa
+import torch
+import torch.nn.functional as F
 
 
 @lru_cache()
-def mel_basis(hp):
+def mel_basis(hp, device="cpu"):
     assert hp.fmax <= hp.sample_rate // 2
-    return librosa.filters.mel(
+    mel = librosa.filters.mel(
         sr=hp.sample_rate,
         n_fft=hp.n_fft,
         n_mels=hp.num_mels,
         fmin=hp.fmin,
         fmax=hp.fmax)  # -> (nmel, nfreq)
+    return torch.from_numpy(mel).float().to(device)
+
+
+@lru_cache()
+def stft_window(hp, device="cpu"):
+    # NOTE: matches librosa's default periodic "hann" window
+    return torch.hann_window(hp.win_size, device=device)
 
 
 def preemphasis(wav, hp):
     assert hp.preemphasis != 0
-    wav = signal.lfilter([1, -hp.preemphasis], [1], wav)
-    wav = np.clip(wav, -1, 1)
+    # y[n] = x[n] - a * x[n - 1], with x[-1] = 0 (same as `lfilter([1, -a], [1], x)`)
+    if isinstance(wav, np.ndarray):
+        wav = np.concatenate((wav[:1], wav[1:] - hp.preemphasis * wav[:-1]))
+        return np.clip(wav, -1, 1)
+    kernel = torch.tensor([[[-hp.preemphasis, 1.0]]], device=wav.device, dtype=wav.dtype)
+    wav = F.conv1d(F.pad(wav.view(1, 1, -1), (1, 0)), kernel).view(-1)
+    wav = torch.clamp(wav, -1, 1)
     return wav
 
 
 def melspectrogram(wav, hp, pad=True):
+    """
+    Computes the mel spectrogram of a 1D waveform with torch, on the waveform's device.
+
+    :param wav: float waveform, either a numpy array or a tensor
+    :return: (M, T) mel spectrogram, of the same type as `wav`
+    """
+    is_numpy = isinstance(wav, np.ndarray)
+    if is_numpy:
+        wav = torch.from_numpy(wav)
+    wav = wav.float()
+
     # Run through pre-emphasis
     if hp.preemphasis > 0:
         wav = preemphasis(wav, hp)
-        assert np.abs(wav).max() - 1 < 1e-07
+        assert wav.abs().max() - 1 < 1e-07
 
     # Do the stft
     spec_complex = _stft(wav, hp, pad=pad)
 
     # Get the magnitudes
-    spec_magnitudes = np.abs(spec_complex)
+    spec_magnitudes = spec_complex.abs()
 
     if hp.mel_power != 1.0:
-        spec_magnitudes **= hp.mel_power
+        spec_magnitudes = spec_magnitudes.pow_(hp.mel_power)
 
     # Get the mel and convert magnitudes->db
-    mel = np.dot(mel_basis(hp), spec_magnitudes)
+    mel = mel_basis(hp, wav.device) @ spec_magnitudes
     if hp.mel_type == "db":
         mel = _amp_to_db(mel, hp)
 
     # Normalise the mel from db to 0,1
     if hp.normalized_mels:
-        mel = _normalize(mel, hp).astype(np.float32)
+        mel = _normalize(mel, hp)
 
     assert not pad or mel.shape[1] == 1 + len(wav) // hp.hop_size   # Sanity check
-    return mel   # (M, T)
+    return mel.cpu().numpy() if is_numpy else mel   # (M, T)
 
 
 def _stft(y, hp, pad=True):
     # NOTE: after 0.8, pad mode defaults to constant, setting this to reflect for
     #   historical consistency and streaming-version consistency
-    return librosa.stft(
+    return torch.stft(
         y,
         n_fft=hp.n_fft,
         hop_length=hp.hop_size,
         win_length=hp.win_size,
+        window=stft_window(hp, y.device),
         center=pad,
         pad_mode="reflect",
+        return_complex=True,
     )
 
 
 def _amp_to_db(x, hp):
-    return 20 * np.log10(np.maximum(hp.stft_magnitude_min, x))
+    return 20 * torch.log10(torch.clamp(x, min=hp.stft_magnitude_min))
 
 
 def _db_to_amp(x):
-    return np.power(10.0, x * 0.05)
+    return torch.pow(10.0, x * 0.05)
 
 
 def _normalize(s, hp, headroom_db=15):
@@ -11,6 +11,7 @@ from torch import nn, Tensor
 
 from .config import VoiceEncConfig
 from .melspec import melspectrogram
+from ..utils import full_precision
 
 
 def pack(arrays, seq_len: int=None, pad_value=0):
@@ -188,7 +189,7 @@ class VoiceEncoder(nn.Module):
 
         # Forward the partials
         n_chunks = int(np.ceil(len(partials) / (batch_size or len(partials))))
-        partial_embeds = torch.cat([self(batch) for batch in partials.chunk(n_chunks)], dim=0).cpu()
+        partial_embeds = torch.cat([self(batch) for batch in partials.chunk(n_chunks)], dim=0).float().cpu()
 
         # Reduce the partial embeds into full embeds and L2-normalize them
         slices = np.concatenate(([0], np.cumsum(n_partials)))
@@ -232,7 +233,7 @@ class VoiceEncoder(nn.Module):
         """
         # Load mels in memory and pack them
         if isinstance(mels, List):
-            mels = [np.asarray(mel) for mel in mels]
+            mels = [mel if torch.is_tensor(mel) else np.asarray(mel) for mel in mels]
             assert all(m.shape[1] == mels[0].shape[1] for m in mels), "Mels aren't in (B, T, M) format"
             mel_lens = [mel.shape[0] for mel in mels]
             mels = pack(mels)
@@ -243,6 +244,7 @@ class VoiceEncoder(nn.Module):
 
         return self.utt_to_spk_embed(utt_embeds) if as_spk else utt_embeds
 
+    @full_precision
     def embeds_from_wavs(
         self,
         wavs: List[np.ndarray],
@@ -269,6 +271,7 @@ class VoiceEncoder(nn.Module):
         if "rate" not in kwargs:
             kwargs["rate"] = 1.3  # Resemble's default value.
 
-        mels = [melspectrogram(w, self.hp).T for w in wavs]
+        # Mels are computed on the encoder's device so they don't need to be moved again before the forward
+        mels = [melspectrogram(torch.as_tensor(w, dtype=torch.float32, device=self.device), self.hp).T for w in wavs]
 
         return self.embeds_from_mels(mels, as_spk=as_spk, batch_size=batch_size, **kwargs)
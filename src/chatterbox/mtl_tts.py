@@ -1,8 +1,11 @@
+from collections import deque
 from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
 import os
 
 import librosa
+import numpy as np
 import torch
 import perth
 import torch.nn.functional as F
@@ -16,6 +19,7 @@ from .models.s3gen import S3GEN_SR, S3Gen
 from .models.tokenizers import MTLTokenizer
 from .models.voice_encoder import VoiceEncoder
 from .models.t3.modules.cond_enc import T3Cond
+from .models.utils import full_precision, quantization_mode, to_numpy
 
 
 REPO_ID = "ResembleAI/chatterbox"
@@ -151,6 +155,8 @@ class ChatterboxMultilingualTTS:
         self.device = device
         self.conds = conds
         self.watermarker = perth.PerthImplicitWatermarker()
+        # Reference prompts are typically reused across many requests
+        self._embed_ref_cached = lru_cache(maxsize=32)(self._embed_ref_uncached)
 
     @classmethod
     def get_supported_languages(cls):
@@ -179,6 +185,8 @@ class ChatterboxMultilingualTTS:
             torch.load(ckpt_dir / "s3gen.pt", weights_only=True)
         )
         s3gen.to(device).eval()
+        if quant_mode := quantization_mode():
+            s3gen.quantize_(quant_mode)
 
         tokenizer = MTLTokenizer(
             str(ckpt_dir / "grapheme_mtl_merged_expanded_v1.json")
@@ -203,7 +211,12 @@ class ChatterboxMultilingualTTS:
         )
         return cls.from_local(ckpt_dir, device)
     
-    def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
+    @full_precision
+    def _embed_ref_uncached(self, wav_fpath, mtime):
+        """
+        Computes the exaggeration-independent conditionals of a reference wav. `mtime` is only part of the
+        cache key, so that edited files are re-embedded. Tensors are returned on the CPU.
+        """
         ## Load reference wav
         s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
 
@@ -211,17 +224,32 @@ class ChatterboxMultilingualTTS:
 
         s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
         s3gen_ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device)
+        s3gen_ref_dict = {k: v.cpu() if torch.is_tensor(v) else v for k, v in s3gen_ref_dict.items()}
 
         # Speech cond prompt tokens
         t3_cond_prompt_tokens = None
         if plen := self.t3.hp.speech_cond_prompt_len:
             s3_tokzr = self.s3gen.tokenizer
             t3_cond_prompt_tokens, _ = s3_tokzr.forward([ref_16k_wav[:self.ENC_COND_LEN]], max_len=plen)
-            t3_cond_prompt_tokens = torch.atleast_2d(t3_cond_prompt_tokens).to(self.device)
+            t3_cond_prompt_tokens = torch.atleast_2d(t3_cond_prompt_tokens).cpu()
 
         # Voice-encoder speaker embedding
         ve_embed = torch.from_numpy(self.ve.embeds_from_wavs([ref_16k_wav], sample_rate=S3_SR))
-        ve_embed = ve_embed.mean(axis=0, keepdim=True).to(self.device)
+        ve_embed = ve_embed.mean(axis=0, keepdim=True)
+
+        return s3gen_ref_dict, t3_cond_prompt_tokens, ve_embed
+
+    def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
+        # only local files are cached (keyed on their mtime, so that edits invalidate the entry); anything else
+        # `librosa.load` accepts, eg, file-like objects, is embedded every time
+        if isinstance(wav_fpath, (str, os.PathLike)) and os.path.isfile(wav_fpath):
+            ref = self._embed_ref_cached(wav_fpath, os.path.getmtime(wav_fpath))
+        else:
+            ref = self._embed_ref_uncached(wav_fpath, None)
+        s3gen_ref_dict, t3_cond_prompt_tokens, ve_embed = ref
+
+        # NOTE: the cache holds CPU copies, so fresh device copies are made for every call
+        s3gen_ref_dict = {k: v.to(self.device) if torch.is_tensor(v) else v for k, v in s3gen_ref_dict.items()}
 
         t3_cond = T3Cond(
             speaker_emb=ve_embed,
@@ -230,18 +258,8 @@ class ChatterboxMultilingualTTS:
         ).to(device=self.device)
         self.conds = Conditionals(t3_cond, s3gen_ref_dict)
 
-    def generate(
-        self,
-        text,
-        language_id,
-        audio_prompt_path=None,
-        exaggeration=0.5,
-        cfg_weight=0.5,
-        temperature=0.8,
-        repetition_penalty=2.0,
-        min_p=0.05,
-        top_p=1.0,
-    ):
+    def _prepare_generation(self, text, language_id, audio_prompt_path, exaggeration):
+        """Validates the inputs, updates the conditionals and returns the (CFG-batched) text tokens."""
         # Validate language_id
         if language_id and language_id.lower() not in SUPPORTED_LANGUAGES:
             supported_langs = ", ".join(SUPPORTED_LANGUAGES.keys())
@@ -273,6 +291,48 @@ class ChatterboxMultilingualTTS:
         eot = self.t3.hp.stop_text_token
         text_tokens = F.pad(text_tokens, (1, 0), value=sot)
         text_tokens = F.pad(text_tokens, (0, 1), value=eot)
+        return text_tokens
+
+    def _watermark(self, wav):
+        wav = to_numpy(wav.squeeze(0))
+        watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
+        return torch.from_numpy(watermarked_wav).unsqueeze(0)
+
+    def _watermark_stream(self, wavs, context=None):
+        """
+        Watermarks a stream of waveform chunks. Each one is watermarked together with (up to) `context` samples of
+        the neighbouring audio on either side and only its middle is emitted, so that there are no discontinuities
+        at the chunk boundaries. The last `context` samples are therefore held back until the next chunk arrives.
+        """
+        context = self.sr // 2 if context is None else context
+        # NOTE: Perth may return slightly fewer samples than it is given (it drops a partial last frame), which
+        #   only ever affects the held-back right context, except for the final window (as for `generate`)
+        buf = np.zeros(0, dtype=np.float32)
+        n_emitted = 0  # at the start of `buf`, already emitted (left context)
+        for wav in wavs:
+            buf = np.concatenate([buf, to_numpy(wav.squeeze(0))])
+            end = len(buf) - context
+            if end > n_emitted:
+                watermarked_wav = self.watermarker.apply_watermark(buf, sample_rate=self.sr)
+                yield torch.from_numpy(watermarked_wav[n_emitted:end]).unsqueeze(0)
+                buf, n_emitted = buf[max(end - context, 0):], min(end, context)
+        if len(buf) > n_emitted:
+            watermarked_wav = self.watermarker.apply_watermark(buf, sample_rate=self.sr)
+            yield torch.from_numpy(watermarked_wav[n_emitted:]).unsqueeze(0)
+
+    def generate(
+        self,
+        text,
+        language_id,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        repetition_penalty=2.0,
+        min_p=0.05,
+        top_p=1.0,
+    ):
+        text_tokens = self._prepare_generation(text, language_id, audio_prompt_path, exaggeration)
 
         with torch.inference_mode():
             speech_tokens = self.t3.inference(
@@ -296,6 +356,116 @@ class ChatterboxMultilingualTTS:
                 speech_tokens=speech_tokens,
                 ref_dict=self.conds.gen,
             )
-            wav = wav.squeeze(0).detach().cpu().numpy()
-            watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
-        return torch.from_numpy(watermarked_wav).unsqueeze(0)
+            return self._watermark(wav)
+
+    def generate_stream(
+        self,
+        text,
+        language_id,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        repetition_penalty=2.0,
+        min_p=0.05,
+        top_p=1.0,
+        chunk_size=25,
+    ):
+        """
+        Same as `generate`, but yields the waveform in chunks: every `chunk_size` speech tokens (1 sec at 25
+        tokens/sec), the new tokens are synthesized with `S3Gen.inference_stream_step` while T3 keeps decoding.
+        The watermark is applied on overlapping windows (see `_watermark_stream`), which delays the chunks by
+        half a second.
+        """
+        # each chunk must cover the speech tail that `S3Gen.inference_stream_step` holds back for the cross-fade
+        min_chunk_size = -(-self.s3gen.stream_mel_cache_len // self.s3gen.flow.token_mel_ratio)
+        if chunk_size < min_chunk_size:
+            raise ValueError(f"chunk_size must be at least {min_chunk_size} tokens, got {chunk_size}")
+
+        return self._watermark_stream(self._synthesize_stream(
+            text,
+            language_id,
+            audio_prompt_path=audio_prompt_path,
+            exaggeration=exaggeration,
+            cfg_weight=cfg_weight,
+            temperature=temperature,
+            repetition_penalty=repetition_penalty,
+            min_p=min_p,
+            top_p=top_p,
+            chunk_size=chunk_size,
+        ))
+
+    @torch.inference_mode()
+    def _synthesize_stream(
+        self,
+        text,
+        language_id,
+        audio_prompt_path,
+        exaggeration,
+        cfg_weight,
+        temperature,
+        repetition_penalty,
+        min_p,
+        top_p,
+        chunk_size,
+    ):
+        """`generate_stream`, before watermarking."""
+        text_tokens = self._prepare_generation(text, language_id, audio_prompt_path, exaggeration)
+
+        # S3Gen needs a few lookahead tokens past the ones it synthesizes, until the last step
+        pre_lookahead_len = self.s3gen.flow.pre_lookahead_len
+        speech_tokens = torch.zeros(0, dtype=torch.long, device=self.device)
+        token_offset = 0
+        cache = None
+
+        # On CUDA, HiFT runs on a side stream so that vocoding a chunk overlaps with decoding the next tokens;
+        # chunks are queued with an event and yielded once it has completed.
+        vocoder_stream = self.s3gen.get_vocoder_stream()
+        pending = deque()  # (wav, event)
+
+        def synthesize(finalize):
+            nonlocal cache
+            n_tokens = len(speech_tokens) if finalize else token_offset + chunk_size + pre_lookahead_len
+            wav, cache = self.s3gen.inference_stream_step(
+                speech_tokens[:n_tokens],
+                ref_dict=self.conds.gen,
+                token_offset=token_offset,
+                cache=cache,
+                finalize=finalize,
+                vocoder_stream=vocoder_stream,
+            )
+            event = None
+            if vocoder_stream is not None:
+                event = torch.cuda.Event()
+                event.record(vocoder_stream)
+            pending.append((wav, event))
+
+        # T3 hands over every token, so that finished chunks can be yielded as soon as they're ready
+        for token_chunk in self.t3.inference_stream(
+            t3_cond=self.conds.t3,
+            text_tokens=text_tokens,
+            max_new_tokens=1000,  # TODO: use the value in config
+            temperature=temperature,
+            cfg_weight=cfg_weight,
+            repetition_penalty=repetition_penalty,
+            min_p=min_p,
+            top_p=top_p,
+            chunk_size=1,
+        ):
+            # Extract only the conditional batch.
+            token_chunk = drop_invalid_tokens(token_chunk[0]).to(self.device)
+            speech_tokens = torch.cat([speech_tokens, token_chunk])
+
+            while pending and (pending[0][1] is None or pending[0][1].query()):
+                yield pending.popleft()[0]
+
+            if len(speech_tokens) - token_offset >= chunk_size + pre_lookahead_len:
+                synthesize(finalize=False)
+                token_offset += chunk_size
+
+        synthesize(finalize=True)
+        while pending:
+            wav, event = pending.popleft()
+            if event is not None:
+                event.synchronize()
+            yield wav
@@ -1,5 +1,7 @@
 from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
+import os
 
 import librosa
 import torch
@@ -14,6 +16,7 @@ from .models.s3gen import S3GEN_SR, S3Gen
 from .models.tokenizers import EnTokenizer
 from .models.voice_encoder import VoiceEncoder
 from .models.t3.modules.cond_enc import T3Cond
+from .models.utils import full_precision, quantization_mode, to_numpy
 
 
 REPO_ID = "ResembleAI/chatterbox"
@@ -124,6 +127,8 @@ class ChatterboxTTS:
         self.device = device
         self.conds = conds
         self.watermarker = perth.PerthImplicitWatermarker()
+        # Reference prompts are typically reused across many requests
+        self._embed_ref_cached = lru_cache(maxsize=32)(self._embed_ref_uncached)
 
     @classmethod
     def from_local(cls, ckpt_dir, device) -> 'ChatterboxTTS':
@@ -153,6 +158,8 @@ class ChatterboxTTS:
             load_file(ckpt_dir / "s3gen.safetensors"), strict=False
         )
         s3gen.to(device).eval()
+        if quant_mode := quantization_mode():
+            s3gen.quantize_(quant_mode)
 
         tokenizer = EnTokenizer(
             str(ckpt_dir / "tokenizer.json")
@@ -179,7 +186,12 @@ class ChatterboxTTS:
 
         return cls.from_local(Path(local_path).parent, device)
 
-    def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
+    @full_precision
+    def _embed_ref_uncached(self, wav_fpath, mtime):
+        """
+        Computes the exaggeration-independent conditionals of a reference wav. `mtime` is only part of the
+        cache key, so that edited files are re-embedded. Tensors are returned on the CPU.
+        """
         ## Load reference wav
         s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
 
@@ -187,16 +199,32 @@ class ChatterboxTTS:
 
         s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
         s3gen_ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device)
+        s3gen_ref_dict = {k: v.cpu() if torch.is_tensor(v) else v for k, v in s3gen_ref_dict.items()}
 
         # Speech cond prompt tokens
+        t3_cond_prompt_tokens = None
         if plen := self.t3.hp.speech_cond_prompt_len:
             s3_tokzr = self.s3gen.tokenizer
             t3_cond_prompt_tokens, _ = s3_tokzr.forward([ref_16k_wav[:self.ENC_COND_LEN]], max_len=plen)
-            t3_cond_prompt_tokens = torch.atleast_2d(t3_cond_prompt_tokens).to(self.device)
+            t3_cond_prompt_tokens = torch.atleast_2d(t3_cond_prompt_tokens).cpu()
 
         # Voice-encoder speaker embedding
         ve_embed = torch.from_numpy(self.ve.embeds_from_wavs([ref_16k_wav], sample_rate=S3_SR))
-        ve_embed = ve_embed.mean(axis=0, keepdim=True).to(self.device)
+        ve_embed = ve_embed.mean(axis=0, keepdim=True)
+
+        return s3gen_ref_dict, t3_cond_prompt_tokens, ve_embed
+
+    def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
+        # only local files are cached (keyed on their mtime, so that edits invalidate the entry); anything else
+        # `librosa.load` accepts, eg, file-like objects, is embedded every time
+        if isinstance(wav_fpath, (str, os.PathLike)) and os.path.isfile(wav_fpath):
+            ref = self._embed_ref_cached(wav_fpath, os.path.getmtime(wav_fpath))
+        else:
+            ref = self._embed_ref_uncached(wav_fpath, None)
+        s3gen_ref_dict, t3_cond_prompt_tokens, ve_embed = ref
+
+        # NOTE: the cache holds CPU copies, so fresh device copies are made for every call
+        s3gen_ref_dict = {k: v.to(self.device) if torch.is_tensor(v) else v for k, v in s3gen_ref_dict.items()}
 
         t3_cond = T3Cond(
             speaker_emb=ve_embed,
@@ -267,6 +295,6 @@ class ChatterboxTTS:
                 speech_tokens=speech_tokens,
                 ref_dict=self.conds.gen,
             )
-            wav = wav.squeeze(0).detach().cpu().numpy()
+            wav = to_numpy(wav.squeeze(0))
             watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
         return torch.from_numpy(watermarked_wav).unsqueeze(0)
\ No newline at end of file
@@ -8,6 +8,7 @@ from safetensors.torch import load_file
 
 from .models.s3tokenizer import S3_SR
 from .models.s3gen import S3GEN_SR, S3Gen
+from .models.utils import quantization_mode, to_numpy
 
 
 REPO_ID = "ResembleAI/chatterbox"
@@ -55,6 +56,8 @@ class ChatterboxVC:
             load_file(ckpt_dir / "s3gen.safetensors"), strict=False
         )
         s3gen.to(device).eval()
+        if quant_mode := quantization_mode():
+            s3gen.quantize_(quant_mode)
 
         return cls(s3gen, device, ref_dict=ref_dict)
 
@@ -99,6 +102,6 @@ class ChatterboxVC:
                 speech_tokens=s3_tokens,
                 ref_dict=self.ref_dict,
             )
-            wav = wav.squeeze(0).detach().cpu().numpy()
+            wav = to_numpy(wav.squeeze(0))
             watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
         return torch.from_numpy(watermarked_wav).unsqueeze(0)
\ No newline at end of file